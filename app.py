@@ -1,17 +1,22 @@
-from flask import Flask, request, jsonify, render_template_string
-import os, time
+from flask import Flask, Response, request, jsonify
+import os, time, json, math, gzip, hashlib, queue, threading, weakref
+from bisect import bisect_left
+try:
+  import brotli                      # optional: pip install Brotli
+except ImportError:
+  brotli = None
+from store import make_store, ApplyError, STATES, ROLLUPS
 
 app = Flask(__name__)
 API_KEY = os.environ.get("API_KEY", "QAwsEDrfTGyhUJikOLp")  # set in Render
 
-# Node store:
-# nodes = {
+# Node store (see store.py), selected with NODE_STORE:
 #   "Room-1": {
 #       "last_update": 0,
 #       "data": {"state":"-", "time":"-", "pirHits":0, "vibHits":0}
 #   }
-# }
-nodes = {}
+# Use NODE_STORE=sqlite:/path/nodes.db when running more than one worker.
+store = make_store()
 
 HTML = """
 <!doctype html>
@@ -114,7 +119,7 @@ button:hover{border-color:#2d3c86; cursor:pointer}
     </div>
   </div>
 
-  <div class="footer">Auto-refresh every 1s · Nodes list every 10s · Theme: Blue</div>
+  <div class="footer" id="footer">Live updates via server push · Theme: Blue</div>
 </div>
 
 <script>
@@ -132,21 +137,16 @@ async function loadNodes(){
   setText('nodeName', sel.value || "-");
 }
 
-async function refresh(){
-  const node = document.getElementById('nodeSel').value;
-  if(!node){ setText('state','-'); setText('time','-'); return; }
-  const js = await j('/live.json?node='+encodeURIComponent(node));
+function render(node, js){
   const d  = js.data || {};
-  const age = Math.max(0, Math.round(Date.now()/1000 - (js.last_update||0)));
+  lastUpdate = js.last_update || 0;
 
   setText('nodeName', node);
   setText('state', d.state || '-');
   setText('time',  d.time || '-');
   setText('pirHits', d.pirHits || 0);
   setText('vibHits', d.vibHits || 0);
-
-  setText('ago', age+'s ago');
-  setText('agoPIR', age+'s ago');
+  tick();
   document.getElementById('footBadge').textContent = (d.vibHits||0) > 0 ? "detected" : "idle";
 
   const st = (d.state||'').toLowerCase();
@@ -155,59 +155,447 @@ async function refresh(){
   else setBadge('statusBadge','ok');
 }
 
-document.getElementById('reloadBtn').addEventListener('click', loadNodes);
-(async()=>{ await loadNodes(); setInterval(refresh,1000); setInterval(loadNodes,10000); refresh(); })();
+// "Ns ago" badges tick locally; no request needed.
+let lastUpdate = 0;
+function tick(){
+  const age = Math.max(0, Math.round(Date.now()/1000 - lastUpdate));
+  setText('ago', age+'s ago');
+  setText('agoPIR', age+'s ago');
+}
+
+async function refresh(){
+  const node = document.getElementById('nodeSel').value;
+  if(!node){ setText('state','-'); setText('time','-'); return; }
+  render(node, await j('/live.json?node='+encodeURIComponent(node)));
+}
+
+// Server push: /stream sends "live" when the selected node changes and
+// "nodes" when the node list changes. Without SSE, or when the server is
+// at its stream limit, fall back to polling and try pushing again later.
+let es = null, polling = null;
+function subscribe(){
+  const node = document.getElementById('nodeSel').value;
+  if(es) es.close();
+  es = new EventSource('/stream?node='+encodeURIComponent(node));
+  es.addEventListener('open', stopPolling);
+  es.addEventListener('live', e => { if(node) render(node, JSON.parse(e.data)); });
+  es.addEventListener('nodes', e => {
+    const sel = document.getElementById('nodeSel');
+    const js = JSON.parse(e.data);
+    if(JSON.stringify(js.nodes) === JSON.stringify([...sel.options].map(o => o.value))) return;
+    loadNodes().then(() => { if(sel.value !== node) subscribe(); });
+  });
+  es.addEventListener('error', () => {
+    if(es.readyState !== EventSource.CLOSED) return;   // browser is reconnecting
+    es = null; startPolling(); setTimeout(subscribe, 60000);
+  });
+}
+
+function startPolling(){
+  if(polling) return;
+  polling = [setInterval(refresh,1000), setInterval(loadNodes,10000)]; refresh();
+  setText('footer','Auto-refresh every 1s · Nodes list every 10s · Theme: Blue');
+}
+function stopPolling(){
+  if(!polling) return;
+  polling.forEach(clearInterval); polling = null;
+  setText('footer','Live updates via server push · Theme: Blue');
+}
+
+const push = () => { if(window.EventSource) subscribe(); else refresh(); };
+document.getElementById('reloadBtn').addEventListener('click', () => loadNodes().then(push));
+document.getElementById('nodeSel').addEventListener('change', () => { if(polling) refresh(); push(); });
+(async()=>{
+  await loadNodes(); setInterval(tick,1000);
+  if(window.EventSource) subscribe(); else startPolling();
+})();
 </script>
 </body>
 </html>
 """
 
+# The dashboard is static, so encode and compress it once at import time
+# instead of running it through Jinja on every hit.
+PAGE = {"identity": HTML.encode("utf-8")}
+PAGE["gzip"] = gzip.compress(PAGE["identity"], 9, mtime=0)
+if brotli:
+  PAGE["br"] = brotli.compress(PAGE["identity"], quality=11)
+# Strong ETags differ per encoding because the bytes differ.
+PAGE_ETAG = {enc: hashlib.sha256(body).hexdigest()[:32] for enc, body in PAGE.items()}
+
 @app.route("/")
 def home():
-  return render_template_string(HTML)
+  enc = next((e for e in ("br", "gzip") if e in PAGE and request.accept_encodings[e]), "identity")
+  headers = {"ETag": '"%s"' % PAGE_ETAG[enc], "Cache-Control": "no-cache", "Vary": "Accept-Encoding"}
+  if request.if_none_match.contains_weak(PAGE_ETAG[enc]):   # RFC 9110: weak comparison
+    return Response(status=304, headers=headers)
+  if enc != "identity":
+    headers["Content-Encoding"] = enc
+  return Response(PAGE[enc], mimetype="text/html", headers=headers)
 
 @app.route("/nodes.json")
 def nodes_list():
-  return jsonify({"nodes": sorted(nodes.keys())})
+  return jsonify({"nodes": store.names()})
+
+def live_data(node):
+  if not node:
+    names = store.names()
+    if not names:
+      return {"last_update":0, "data":{}}
+    node = names[0]
+  return store.get(node) or {"last_update":0, "data":{}}
 
 @app.route("/live.json")
 def live():
+  return jsonify(live_data(request.args.get("node")))
+
+@app.route("/history.json")
+def history():
+  # Per-node event history, oldest first: ?node=Room-1&since=<unix>&until=<unix>
   node = request.args.get("node")
   if not node:
-    if not nodes:
-      return jsonify({"last_update":0, "data":{}})
-    node = sorted(nodes.keys())[0]
-  return jsonify(nodes.get(node, {"last_update":0, "data":{}}))
+    return jsonify({"error":"node is required"}), 400
+  since = request.args.get("since", 0, type=int)
+  until = request.args.get("until", 2**32 - 1, type=int)
+  events = [{"ts":ts, "state":STATES[code], "pirHits":pir, "vibHits":vib}
+            for ts, code, pir, vib in store.history(node, since, until)]
+  return jsonify({"node":node, "events":events})
+
+@app.route("/stats.json")
+def stats():
+  # Pre-aggregated rollups: ?res=minute|hour|day[&node=Room-1][&since=<unix>][&until=<unix>]
+  res = request.args.get("res", "minute")
+  if res not in ROLLUPS:
+    return jsonify({"error":"res must be one of %s" % ", ".join(ROLLUPS)}), 400
+  node = request.args.get("node")
+  since = request.args.get("since", 0, type=int)
+  until = request.args.get("until", 2**32 - 1, type=int)
+  keys = ("bucket", "count", "first", "last", "motion", "vibration", "other")
+  rolls = store.rollups(res, node, since, until)
+  return jsonify({"res":res, "width":ROLLUPS[res][0],
+                  "nodes":{n: [dict(zip(keys, r)) for r in rows] for n, rows in rolls.items()}})
+
+STREAM_KEEPALIVE = 15  # seconds; keeps proxies from closing idle streams
+STREAM_MAX_AGE = 300   # seconds; the browser reconnects, so threads cycle
+# Every open stream holds one worker thread. Keep MAX_STREAMS well below
+# the gunicorn --threads count (32 in the Procfile) so ingest and reads
+# always have threads left; extra dashboards get 503 and fall back to
+# polling /live.json.
+MAX_STREAMS = int(os.environ.get("MAX_STREAMS", 16))
+open_streams = 0
+streams_lock = threading.Lock()
+nodes_cache = (None, None)     # (store version, serialised nodes payload)
+
+def nodes_payload(v):
+  # Shared by all streams: rebuilt once per store version, not once per stream.
+  global nodes_cache
+  cv, body = nodes_cache
+  if cv != v:
+    body = json.dumps({"nodes": store.names()}, separators=(",",":"))
+    nodes_cache = (v, body)
+  return body
+
+def release_stream():
+  global open_streams
+  with streams_lock:
+    open_streams -= 1
+
+@app.route("/stream")
+def stream():
+  # Server-Sent Events: push "live"/"nodes" only when the store version moves.
+  global open_streams
+  with streams_lock:
+    if open_streams >= MAX_STREAMS:
+      return "Too many streams, poll /live.json", 503, {"Retry-After": "60"}
+    open_streams += 1
+  node = request.args.get("node")
+  def events():
+    sent = {}
+    v = store.version()
+    end = time.monotonic() + STREAM_MAX_AGE
+    yield "retry: 2000\n\n"
+    while time.monotonic() < end:
+      for name, body in (("nodes", nodes_payload(v)),
+                         ("live", json.dumps(live_data(node), separators=(",",":")))):
+        if sent.get(name) != body:
+          sent[name] = body
+          yield "event: %s\ndata: %s\n\n" % (name, body)
+      nv = store.wait(v, STREAM_KEEPALIVE)
+      if nv == v:
+        yield ": keepalive\n\n"
+      v = nv
+  resp = Response(events(), mimetype="text/event-stream",
+                  headers={"Cache-Control":"no-cache", "X-Accel-Buffering":"no"})
+  resp.call_on_close(release_stream)
+  return resp
+
+MAX_HITS = 2**63 - 1   # largest count an SQLite INTEGER column holds
+BAD_EVENT = (TypeError, ValueError, OverflowError)
+
+def finite(v, name):
+  # JSON NaN / Infinity (and 1e400, which parses as inf) are not usable values.
+  if isinstance(v, float) and not math.isfinite(v):
+    raise ValueError("%s must be finite" % name)
+  return v
+
+def parse_event(data, now):
+  # Validates everything the stores rely on, so an accepted event can be
+  # applied (the queued writer has no way to report errors). Raises one of
+  # BAD_EVENT.
+  if not isinstance(data, dict):
+    raise ValueError("event must be an object")
+  node  = data.get("node","Room-1")
+  state = data.get("state","-")      # "Motion" or "Vibration"
+  t     = finite(data.get("time","-"), "time")
+  pirH  = int(finite(data.get("pirHits", 0), "pirHits"))
+  vibH  = int(finite(data.get("vibHits", 0), "vibHits"))
+  if not isinstance(node, str) or not node:
+    raise ValueError("node must be a non-empty string")
+  if not isinstance(state, str):
+    raise ValueError("state must be a string")
+  if isinstance(t, bool) or not isinstance(t, (str, int, float)):
+    raise ValueError("time must be a string or a number")
+  if not (0 <= pirH <= MAX_HITS and 0 <= vibH <= MAX_HITS):
+    raise ValueError("pirHits and vibHits must be between 0 and %d" % MAX_HITS)
+  # Stored as text either way, so both backends report the same value.
+  return (node, state, str(t), pirH, vibH, now)
 
 @app.route("/pir_event", methods=["POST"])
 def pir_event():
   if request.headers.get("X-API-Key") != API_KEY:
     return "Forbidden", 403
 
-  data = request.get_json(silent=True) or {}
-  node  = data.get("node","Room-1")
-  state = data.get("state","-")      # "Motion" or "Vibration"
-  t     = data.get("time","-")
-  pirH  = int(data.get("pirHits", 0))
-  vibH  = int(data.get("vibHits", 0))
+  data = request.get_json(silent=True)
+  try:
+    event = parse_event({} if data is None else data, int(time.time()))
+  except BAD_EVENT as e:
+    return "Bad Request: %s" % e, 400
+  failed = ingest([event])
+  if failed is None:
+    return busy()
+  if failed:
+    return "Unprocessable: %s" % failed[0], 422
+  return "OK", 200
 
-  if node not in nodes:
-    nodes[node] = {"last_update":0, "data":{"state":"-","time":"-","pirHits":0,"vibHits":0}}
+MAX_BATCH = 5000
 
-  d = nodes[node]["data"]
+@app.route("/pir_events", methods=["POST"])
+def pir_events():
+  # Batch ingest: a JSON array of pir_event bodies, or NDJSON (one per line)
+  # with Content-Type application/x-ndjson. Events apply in order in one pass.
+  if request.headers.get("X-API-Key") != API_KEY:
+    return "Forbidden", 403
 
-  # Prefer device-supplied totals if nonzero; else increment
-  if pirH>0 or vibH>0:
-    if pirH>0: d["pirHits"] = pirH
-    if vibH>0: d["vibHits"] = vibH
+  if request.mimetype == "application/x-ndjson":
+    lines = [l for l in request.get_data(as_text=True).splitlines() if l.strip()]
   else:
-    if state.lower().startswith("motion"):   d["pirHits"] += 1
-    if state.lower().startswith("vibration"):d["vibHits"] += 1
+    lines = request.get_json(silent=True)
+    if not isinstance(lines, list):
+      return jsonify({"error":"expected a JSON array of events"}), 400
+  if len(lines) > MAX_BATCH:
+    return jsonify({"error":"batch larger than %d events" % MAX_BATCH}), 413
 
-  d["state"] = state
-  d["time"]  = t
-  nodes[node]["last_update"] = int(time.time())
-  return "OK", 200
+  now = int(time.time())
+  events, slots, results = [], [], []
+  for item in lines:
+    try:
+      data = json.loads(item) if isinstance(item, str) else item
+      events.append(parse_event(data, now))
+      slots.append(len(results))
+      results.append({"status":"ok"})
+    except BAD_EVENT as e:
+      results.append({"status":"error", "error":str(e)})
+
+  failed = ingest(events)
+  if failed is None:
+    return busy()
+  for i, err in failed.items():
+    results[slots[i]] = {"status":"error", "error":err}
+  return jsonify({"applied":len(events) - len(failed), "results":results}), 200
+
+# Ingest modes (INGEST_MODE):
+#   "sync"  - apply events inside the request (default)
+#   "queue" - validate, enqueue and ack; one writer thread per process
+#             applies batches in arrival order. The queue is bounded by the
+#             number of queued events; when a request would overflow it the
+#             answer is 503 + Retry-After instead of piling up latency.
+INGEST_MODE  = os.environ.get("INGEST_MODE", "sync")
+INGEST_QUEUE = int(os.environ.get("INGEST_QUEUE", 10000))  # max queued events
+RETRY_AFTER  = 1                                           # seconds
+ingest_q = queue.Queue()
+ingest_queued = 0              # events currently in ingest_q
+ingest_lock = threading.Lock()
+ingest_writer = None
+
+def ingest(events):
+  # Returns None when the queue is full, else {index: error} for events the
+  # store rejected (always empty in queue mode, where errors are logged).
+  global ingest_queued
+  failed = {}
+  if INGEST_MODE != "queue":
+    failed = apply_events(events)
+  else:
+    start_ingest_writer()
+    with ingest_lock:
+      # An empty queue always takes one request, however large.
+      if ingest_queued and ingest_queued + len(events) > INGEST_QUEUE:
+        return None
+      ingest_queued += len(events)
+    ingest_q.put(events)
+  count_events([e for i, e in enumerate(events) if i not in failed])
+  return failed
+
+def apply_events(events):
+  # Apply in order; on ApplyError drop only the failing event and retry
+  # what did not take effect, so one bad event cannot take its batch
+  # neighbours with it. Returns {index: error} for the dropped events.
+  failed, idx = {}, list(range(len(events)))
+  while events:
+    try:
+      store.apply_many(events)
+      break
+    except ApplyError as e:
+      failed[idx[e.failed]] = str(e.__cause__)
+      events = events[e.applied:e.failed] + events[e.failed + 1:]
+      idx = idx[e.applied:e.failed] + idx[e.failed + 1:]
+  return failed
+
+def busy():
+  return "Busy, retry later", 503, {"Retry-After": str(RETRY_AFTER)}
+
+def start_ingest_writer():
+  # Lazily, and again after a fork, since threads do not survive fork().
+  global ingest_writer
+  if ingest_writer is None or ingest_writer[1] != os.getpid():
+    t = threading.Thread(target=ingest_loop, name="ingest-writer", daemon=True)
+    ingest_writer = (t, os.getpid())
+    t.start()
+
+def ingest_loop():
+  global ingest_queued
+  while True:
+    # Coalesce whatever is already queued into one store call.
+    events = list(ingest_q.get())
+    try:
+      while len(events) < MAX_BATCH:
+        events.extend(ingest_q.get_nowait())
+    except queue.Empty:
+      pass
+    with ingest_lock:
+      ingest_queued -= len(events)
+    try:
+      for i, err in apply_events(events).items():
+        app.logger.error("ingest writer: dropped event for node %r: %s", events[i][0], err)
+    except Exception:
+      app.logger.exception("ingest writer: dropped %d events", len(events))
+
+# Metrics. Each thread updates its own shard of plain dicts, so the request
+# path takes no locks; /metrics sums the shards when scraped. When a thread
+# exits, its shard is folded into metric_totals, so short-lived threads
+# (one per request under app.run) do not pile up. Values are per process
+# (each gunicorn worker reports its own).
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+STALE_AFTER = int(os.environ.get("STALE_AFTER", 60))  # seconds without an update
+metric_shards = []
+metric_shards_lock = threading.Lock()
+metric_local = threading.local()
+
+def new_shard():
+  # requests: (endpoint, code) -> n; latency: endpoint -> [bucket counts..., +Inf, sum]
+  return {"requests":{}, "latency":{}, "events":{}}
+
+metric_totals = new_shard()    # shards of threads that have exited
+
+def merge_shard(dst, src):
+  for k, v in list(src["requests"].items()):
+    dst["requests"][k] = dst["requests"].get(k, 0) + v
+  for k, h in list(src["latency"].items()):
+    acc = dst["latency"].setdefault(k, [0] * len(h))
+    for i, v in enumerate(list(h)):
+      acc[i] += v
+  for k, v in list(src["events"].items()):
+    dst["events"][k] = dst["events"].get(k, 0) + v
+
+def retire_shard(s):
+  with metric_shards_lock:
+    merge_shard(metric_totals, s)
+    metric_shards.remove(s)
+
+class ShardOwner:
+  # Lives in the thread-local; collected when its thread exits.
+  __slots__ = ("shard", "__weakref__")
+
+def metric_shard():
+  owner = getattr(metric_local, "owner", None)
+  if owner is None:
+    owner = metric_local.owner = ShardOwner()
+    owner.shard = new_shard()
+    with metric_shards_lock:
+      metric_shards.append(owner.shard)
+    weakref.finalize(owner, retire_shard, owner.shard)
+  return owner.shard
+
+def observe(endpoint, code, seconds):
+  s = metric_shard()
+  key = (endpoint, code)
+  s["requests"][key] = s["requests"].get(key, 0) + 1
+  h = s["latency"].get(endpoint)
+  if h is None:
+    h = s["latency"][endpoint] = [0] * (len(LATENCY_BUCKETS) + 1) + [0.0]
+  h[bisect_left(LATENCY_BUCKETS, seconds)] += 1
+  h[-1] += seconds
+
+def count_events(events):
+  ev = metric_shard()["events"]
+  for e in events:
+    ev[e[0]] = ev.get(e[0], 0) + 1
+
+@app.before_request
+def start_timer():
+  request.environ["esp.start"] = time.perf_counter()
+
+@app.after_request
+def record_request(response):
+  start = request.environ.get("esp.start")
+  if start is not None:
+    observe(request.endpoint or "unmatched", response.status_code, time.perf_counter() - start)
+  return response
+
+def label(v):
+  return str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+@app.route("/metrics")
+def metrics():
+  total = new_shard()
+  with metric_shards_lock:
+    merge_shard(total, metric_totals)
+    for s in metric_shards:
+      merge_shard(total, s)
+  reqs, latency, events = total["requests"], total["latency"], total["events"]
+
+  nodes, stale = store.node_counts(int(time.time()) - STALE_AFTER)
+
+  out = ["# TYPE esp_http_requests_total counter"]
+  for (ep, code), v in sorted(reqs.items()):
+    out.append('esp_http_requests_total{endpoint="%s",code="%d"} %d' % (label(ep), code, v))
+  out.append("# TYPE esp_http_request_duration_seconds histogram")
+  for ep, h in sorted(latency.items()):
+    cum = 0
+    for le, v in zip(LATENCY_BUCKETS + ("+Inf",), h):
+      cum += v
+      out.append('esp_http_request_duration_seconds_bucket{endpoint="%s",le="%s"} %d' % (label(ep), le, cum))
+    out.append('esp_http_request_duration_seconds_sum{endpoint="%s"} %.6f' % (label(ep), h[-1]))
+    out.append('esp_http_request_duration_seconds_count{endpoint="%s"} %d' % (label(ep), cum))
+  out.append("# TYPE esp_node_events_total counter")
+  for node, v in sorted(events.items()):
+    out.append('esp_node_events_total{node="%s"} %d' % (label(node), v))
+  out.append("# TYPE esp_nodes gauge")
+  out.append("esp_nodes %d" % nodes)
+  out.append("# TYPE esp_nodes_stale gauge")
+  out.append('esp_nodes_stale{after_seconds="%d"} %d' % (STALE_AFTER, stale))
+  out.append("# TYPE esp_ingest_queue_depth gauge")
+  out.append("esp_ingest_queue_depth %d" % ingest_queued)
+  return Response("\n".join(out) + "\n", mimetype="text/plain; version=0.0.4")
 
 if __name__ == "__main__":
   app.run(host="0.0.0.0", port=int(os.environ.get("PORT", 5000)))
@@ -0,0 +1,359 @@
+"""Load test for the ingest and read endpoints.
+
+Simulates --nodes ESP nodes posting /pir_event at --rate events/s each (or
+/pir_events in batches of --batch) while --dashboards clients poll /live.json
+and --streams clients hold /stream open, then prints one JSON report with
+throughput, p50/p95/p99 latency and memory growth per endpoint.
+
+  python bench.py                                  # in-process Flask test client
+  python bench.py --batch 50 --streams 8           # batched ingest + SSE readers
+  python bench.py --gunicorn --workers 4           # spawn gunicorn on a free port
+  python bench.py --url http://host:5000           # an already running server
+  python bench.py --recovery 500000                # time durable-store recovery
+  python bench.py --metrics-overhead 1000000       # per-request metrics cost
+
+Store and ingest options are passed through the usual NODE_STORE /
+INGEST_MODE environment variables. --gunicorn with more than one worker
+uses a temporary SQLite store unless NODE_STORE names a shared one.
+"""
+import argparse, http.client, json, os, shutil, socket, subprocess, sys, tempfile, threading, time
+from urllib.parse import urlsplit
+
+
+def percentile(xs, p):
+  if not xs:
+    return None
+  xs = sorted(xs)
+  return xs[min(len(xs) - 1, int(round(p / 100.0 * (len(xs) - 1))))]
+
+def summarize(lat, errors, elapsed):
+  ms = [x * 1000 for x in lat]
+  return {"requests":len(lat), "errors":errors, "rps":round(len(lat) / elapsed, 1),
+          "p50_ms":percentile(ms, 50), "p95_ms":percentile(ms, 95), "p99_ms":percentile(ms, 99),
+          "max_ms":max(ms) if ms else None}
+
+def rss_kb(pid):
+  # Resident set of pid plus its children (gunicorn workers), Linux only.
+  if pid is None:
+    return None
+  total = 0
+  try:
+    with open("/proc/%d/status" % pid) as f:
+      for line in f:
+        if line.startswith("VmRSS:"):
+          total += int(line.split()[1])
+    with open("/proc/%d/task/%d/children" % (pid, pid)) as f:
+      for child in f.read().split():
+        total += rss_kb(int(child)) or 0
+  except OSError:
+    return total or None
+  return total
+
+
+class TestClient:
+  # In-process: one Flask test client per thread.
+  def __init__(self, app, api_key):
+    self.app, self.key = app, api_key
+
+  def __call__(self):
+    c = self.app.test_client()
+    def post(path, body):
+      r = c.post(path, data=body, headers={"X-API-Key":self.key, "Content-Type":"application/json"})
+      return r.status_code
+    def get(path):
+      return c.get(path).status_code
+    def stream(path, stop, on_event):
+      r = c.get(path, buffered=False)
+      if r.status_code != 200:
+        return r.status_code
+      try:
+        for chunk in r.response:
+          if chunk.startswith(b"event:"):
+            on_event()
+          if time.monotonic() >= stop:
+            break
+      finally:
+        r.close()
+      return 200
+    return post, get, stream
+
+
+class HTTPClient:
+  # Over the network: one keep-alive connection per thread.
+  def __init__(self, url, api_key):
+    u = urlsplit(url)
+    self.host, self.port, self.key = u.hostname, u.port or 80, api_key
+
+  def __call__(self):
+    conn = [http.client.HTTPConnection(self.host, self.port, timeout=30)]
+    def send(method, path, body=None, headers={}):
+      for attempt in (0, 1):
+        try:
+          conn[0].request(method, path, body=body, headers=headers)
+          r = conn[0].getresponse()
+          r.read()
+          return r.status
+        except (http.client.HTTPException, OSError):
+          conn[0].close()
+          conn[0] = http.client.HTTPConnection(self.host, self.port, timeout=30)
+          if attempt:
+            return 0
+    def post(path, body):
+      return send("POST", path, body, {"X-API-Key":self.key, "Content-Type":"application/json"})
+    def get(path):
+      return send("GET", path)
+    def stream(path, stop, on_event):
+      c = http.client.HTTPConnection(self.host, self.port, timeout=1)
+      try:
+        c.request("GET", path)
+        r = c.getresponse()
+        if r.status != 200:
+          return r.status
+        while time.monotonic() < stop:
+          try:
+            line = r.fp.readline()
+          except socket.timeout:
+            continue
+          if not line:
+            break
+          if line.startswith(b"event:"):
+            on_event()
+        return 200
+      except (http.client.HTTPException, OSError):
+        return 0
+      finally:
+        c.close()
+    return post, get, stream
+
+
+def run_load(make_client, args, server_pid):
+  # Rates are taken over the load window [t0, stop); requests still in
+  # flight at stop are counted but the time spent joining is not.
+  t0 = time.monotonic()
+  stop = t0 + args.duration
+  lock = threading.Lock()
+  ingest = "pir_events" if args.batch > 1 else "pir_event"
+  stats = {ingest:([], [0]), "live.json":([], [0])}
+  streamed = {"events":0, "rejected":0}
+
+  def record(name, dt, status):
+    lat, err = stats[name]
+    with lock:
+      lat.append(dt)
+      if status != 200:
+        err[0] += 1
+
+  def poster(nodes):
+    post = make_client()[0]
+    # This thread's share of the fleet, sent round-robin at the combined rate,
+    # one event per /pir_event request or --batch events per /pir_events.
+    per = max(1, args.batch)
+    interval = per / (len(nodes) * args.rate) if args.rate > 0 else 0
+    due, i = time.monotonic(), 0
+    while True:
+      now = time.monotonic()
+      if now >= stop:
+        return
+      if now < due:
+        time.sleep(min(due, stop) - now)
+        continue
+      evs = [{"node":nodes[k % len(nodes)], "state":"Motion" if k % 2 else "Vibration", "time":"bench"}
+             for k in range(i, i + per)]
+      body = json.dumps(evs if args.batch > 1 else evs[0])
+      t = time.perf_counter()
+      status = post("/" + ingest, body)
+      record(ingest, time.perf_counter() - t, status)
+      i += per
+      due += interval
+
+  def dashboard(k):
+    get = make_client()[1]
+    interval = 1.0 / args.poll if args.poll > 0 else 0
+    due = time.monotonic()
+    while True:
+      now = time.monotonic()
+      if now >= stop:
+        return
+      if now < due:
+        time.sleep(min(due, stop) - now)
+        continue
+      t = time.perf_counter()
+      status = get("/live.json?node=bench-%d" % (k % args.nodes))
+      record("live.json", time.perf_counter() - t, status)
+      due += interval
+
+  def reader(k):
+    stream = make_client()[2]
+    def on_event():
+      with lock:
+        streamed["events"] += 1
+    while time.monotonic() < stop:
+      if stream("/stream?node=bench-%d" % (k % args.nodes), stop, on_event) != 200:
+        with lock:
+          streamed["rejected"] += 1
+        time.sleep(max(0, min(1, stop - time.monotonic())))
+
+  names = ["bench-%d" % i for i in range(args.nodes)]
+  shares = [names[i::args.senders] for i in range(min(args.senders, args.nodes))]
+  threads = [threading.Thread(target=poster, args=(s,)) for s in shares]
+  threads += [threading.Thread(target=dashboard, args=(k,)) for k in range(args.dashboards)]
+  threads += [threading.Thread(target=reader, args=(k,)) for k in range(args.streams)]
+  rss0 = rss_kb(server_pid)
+  for th in threads:
+    th.start()
+  for th in threads:
+    th.join()
+  elapsed = stop - t0
+  rss1 = rss_kb(server_pid)
+  return {
+    "elapsed_s":round(elapsed, 3),
+    "endpoints":{name: summarize(lat, err[0], elapsed) for name, (lat, err) in stats.items()},
+    "events_per_s":round(len(stats[ingest][0]) * max(1, args.batch) / elapsed, 1),
+    "stream":{"clients":args.streams, "events":streamed["events"], "rejected":streamed["rejected"],
+              "events_per_s":round(streamed["events"] / elapsed, 1)},
+    "memory":{"rss_start_kb":rss0, "rss_end_kb":rss1,
+              "rss_growth_kb":(rss1 - rss0) if rss0 is not None and rss1 is not None else None},
+  }
+
+
+def free_port():
+  with socket.socket() as s:
+    s.bind(("127.0.0.1", 0))
+    return s.getsockname()[1]
+
+def start_gunicorn(args, env):
+  port = free_port()
+  cmd = [sys.executable, "-m", "gunicorn", "-w", str(args.workers), "--worker-class", "gthread",
+         "--threads", str(args.threads), "-b", "127.0.0.1:%d" % port, "app:app"]
+  proc = subprocess.Popen(cmd, cwd=os.path.dirname(os.path.abspath(__file__)), env=env,
+                          stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+  end = time.monotonic() + 15
+  while time.monotonic() < end:
+    try:
+      socket.create_connection(("127.0.0.1", port), timeout=0.2).close()
+      return proc, "http://127.0.0.1:%d" % port
+    except OSError:
+      time.sleep(0.1)
+  proc.kill()
+  raise SystemExit("gunicorn did not start")
+
+
+def bench_recovery(events, nodes):
+  # Build a durable MemoryStore log of `events` events, then time a cold
+  # start from the raw log and from a snapshot plus empty tail.
+  import store
+  d = tempfile.mkdtemp(prefix="esp-bench-")
+  try:
+    store.SNAPSHOT_EVERY = events + 1
+    s = store.MemoryStore(d)
+    base = int(time.time()) - events // 100
+    batch = []
+    for i in range(events):
+      batch.append(("bench-%d" % (i % nodes), "Motion" if i % 2 else "Vibration", "bench", 0, 0, base + i // 100))
+      if len(batch) == 5000:
+        s.apply_many(batch)
+        batch = []
+    s.apply_many(batch)
+    s.flush()
+    t = time.perf_counter()
+    s = store.MemoryStore(d)
+    replay = time.perf_counter() - t
+    s.snapshot()
+    t = time.perf_counter()
+    store.MemoryStore(d)
+    snap = time.perf_counter() - t
+    return {"events":events, "nodes":nodes, "replay_log_s":round(replay, 3),
+            "load_snapshot_s":round(snap, 3),
+            "snapshot_bytes":os.path.getsize(os.path.join(d, "snapshot.json"))}
+  finally:
+    shutil.rmtree(d, ignore_errors=True)
+
+
+def bench_metrics(n):
+  # Cost of the per-request instrumentation: observe() runs on every
+  # request, count_events() once per ingested event.
+  import app
+  t = time.perf_counter()
+  for i in range(n):
+    app.observe("bench", 200, 0.0012)
+  observe = time.perf_counter() - t
+  events = [("bench-%d" % (i % 100), "Motion", "bench", 0, 0, 0) for i in range(1000)]
+  t = time.perf_counter()
+  for i in range(max(1, n // 1000)):
+    app.count_events(events)
+  count = time.perf_counter() - t
+  t = time.perf_counter()
+  app.metrics()
+  scrape = time.perf_counter() - t
+  return {"observe_us":round(observe / n * 1e6, 3),
+          "count_event_us":round(count / (max(1, n // 1000) * 1000) * 1e6, 3),
+          "scrape_ms":round(scrape * 1000, 3)}
+
+
+def main(argv=None):
+  p = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  p.add_argument("--nodes", type=int, default=100, help="virtual ESP nodes")
+  p.add_argument("--rate", type=float, default=1.0, help="events/s per node (0 = as fast as possible)")
+  p.add_argument("--senders", type=int, default=8, help="threads sharing the node fleet")
+  p.add_argument("--batch", type=int, default=1, help="events per request; >1 posts to /pir_events")
+  p.add_argument("--dashboards", type=int, default=10, help="polling dashboard clients")
+  p.add_argument("--poll", type=float, default=1.0, help="polls/s per dashboard (0 = as fast as possible)")
+  p.add_argument("--streams", type=int, default=0, help="clients holding /stream open")
+  p.add_argument("--duration", type=float, default=10.0, help="seconds")
+  p.add_argument("--url", help="benchmark a running server instead of the in-process app")
+  p.add_argument("--gunicorn", action="store_true", help="spawn a local gunicorn for the run")
+  p.add_argument("--workers", type=int, default=2, help="gunicorn workers (with --gunicorn)")
+  p.add_argument("--threads", type=int, default=8, help="gunicorn threads per worker (with --gunicorn)")
+  p.add_argument("--recovery", type=int, metavar="EVENTS", help="only time durable-store recovery")
+  p.add_argument("--metrics-overhead", type=int, metavar="N", help="only time N metric observations")
+  p.add_argument("--out", help="write the JSON report here instead of stdout")
+  args = p.parse_args(argv)
+
+  report = {"config":{k: v for k, v in vars(args).items() if k != "out"},
+            "env":{k: os.environ.get(k) for k in ("NODE_STORE", "INGEST_MODE")}}
+  if args.recovery:
+    report["recovery"] = bench_recovery(args.recovery, args.nodes)
+  elif args.metrics_overhead:
+    report["metrics"] = bench_metrics(args.metrics_overhead)
+  else:
+    proc, tmp = None, None
+    api_key = os.environ.get("API_KEY", "QAwsEDrfTGyhUJikOLp")
+    if args.gunicorn:
+      env = dict(os.environ)
+      spec = env.get("NODE_STORE", "memory")
+      if args.workers > 1 and spec.split(":")[0] == "memory":
+        # Per-process memory stores would split the fleet between workers.
+        if "NODE_STORE" in env:
+          raise SystemExit("NODE_STORE=%s is per process; use sqlite with --workers > 1" % spec)
+        tmp = tempfile.mkdtemp(prefix="esp-bench-")
+        env["NODE_STORE"] = "sqlite:" + os.path.join(tmp, "nodes.db")
+        report["env"]["NODE_STORE"] = env["NODE_STORE"]
+      env.setdefault("MAX_STREAMS", str(max(args.streams, 1)))
+      proc, args.url = start_gunicorn(args, env)
+    try:
+      if args.url:
+        report["mode"] = "http"
+        pid = proc.pid if proc else None
+        report.update(run_load(HTTPClient(args.url, api_key), args, pid))
+      else:
+        import app
+        app.STREAM_KEEPALIVE = 1    # so readers notice the end of the run
+        app.MAX_STREAMS = max(app.MAX_STREAMS, args.streams)
+        report["mode"] = "test_client"
+        report.update(run_load(TestClient(app.app, app.API_KEY), args, os.getpid()))
+    finally:
+      if proc:
+        proc.terminate()
+        proc.wait()
+      if tmp:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+  out = json.dumps(report, indent=2)
+  if args.out:
+    with open(args.out, "w") as f:
+      f.write(out + "\n")
+  else:
+    print(out)
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,613 @@
+import os, re, json, base64, atexit, logging, sqlite3, threading, time
+from array import array
+from bisect import bisect_left, bisect_right
+
+# Node store backends. Every backend exposes the same small API:
+#   names()                               -> sorted node names
+#   get(node)                             -> {"last_update":..,"data":{..}} or None
+#   apply(node, state, t, pirH, vibH, now) -> apply one event with the hit-count rules
+#   apply_many(events)                    -> apply (node, state, t, pirH, vibH, now) tuples in order
+#   history(node, since, until)           -> [(ts, state_code, pirHits, vibHits)] oldest first
+#   rollups(res, node, since, until)      -> {node: [(bucket, count, first, last, motion, vibration, other)]}
+#   node_counts(before)                   -> (nodes, nodes with last_update < before)
+#   version()                             -> counter bumped by every apply
+#   wait(since, timeout)                  -> block until version() != since or timeout
+#
+# MemoryStore keeps state in the process (single worker only). Given a
+# directory it is made durable with an append-only event log plus periodic
+# snapshots (see MemoryStore.snapshot / _recover).
+# SQLiteStore keeps state in one WAL-mode database file shared by every
+# gunicorn worker on the host, so all workers see the same counters.
+
+class ApplyError(Exception):
+  # Raised by apply_many: events[:applied] took effect, events[failed] did not
+  # apply, and nothing else in the batch took effect.
+  def __init__(self, applied, failed, cause):
+    super().__init__("event %d failed: %r" % (failed, cause))
+    self.applied, self.failed = applied, failed
+
+log = logging.getLogger(__name__)
+
+def empty_node():
+  return {"last_update":0, "data":{"state":"-","time":"-","pirHits":0,"vibHits":0}}
+
+# Compact per-event state codes kept in history.
+STATES = ("-", "Motion", "Vibration")
+HISTORY_CAP = int(os.environ.get("HISTORY_CAP", 1024))  # events kept per node
+U32 = 0xFFFFFFFF
+
+# Rollup resolutions: name -> (bucket width, retention), both in seconds.
+ROLLUPS = {
+  "minute": (60, 24*3600),
+  "hour":   (3600, 31*24*3600),
+  "day":    (86400, 366*24*3600),
+}
+EVICT_EVERY = 60  # seconds (of event time) between retention sweeps
+
+FLUSH_EVERY = float(os.environ.get("FLUSH_EVERY", 0.05))         # log group-commit window, seconds
+SNAPSHOT_EVERY = int(os.environ.get("SNAPSHOT_EVERY", 100000))  # logged events between snapshots
+
+def state_code(state):
+  st = state.lower()
+  return 1 if st.startswith("motion") else 2 if st.startswith("vibration") else 0
+
+def hit_update(state, pirH, vibH):
+  # Prefer device-supplied totals if nonzero; else increment.
+  # Returns (pirSet, vibSet, pirInc, vibInc); a None "set" means keep + inc.
+  if pirH>0 or vibH>0:
+    return (pirH if pirH>0 else None), (vibH if vibH>0 else None), 0, 0
+  st = state.lower()
+  return None, None, int(st.startswith("motion")), int(st.startswith("vibration"))
+
+def b64(a):
+  return base64.b64encode(a.tobytes()).decode("ascii")
+
+
+class Ring:
+  # Fixed-capacity history for one node: parallel typed arrays (13 bytes per
+  # event) that grow up to cap and then overwrite the oldest slot.
+  def __init__(self, cap):
+    self.cap, self.start = cap, 0
+    self.ts, self.code = array("I"), array("B")
+    self.pir, self.vib = array("I"), array("I")
+
+  def append(self, ts, code, pir, vib):
+    # Timestamps must stay sorted for bisect; a wall-clock step back is clamped.
+    n = len(self.ts)
+    if n:
+      ts = max(ts, self.ts[(self.start + n - 1) % self.cap])
+    row = (min(ts, U32), code, min(pir, U32), min(vib, U32))
+    if n < self.cap:
+      for a, v in zip((self.ts, self.code, self.pir, self.vib), row):
+        a.append(v)
+    else:
+      i = self.start
+      self.ts[i], self.code[i], self.pir[i], self.vib[i] = row
+      self.start = (i + 1) % self.cap
+
+  def copy(self):
+    r = Ring(self.cap)
+    r.start = self.start
+    r.ts, r.code, r.pir, r.vib = self.ts[:], self.code[:], self.pir[:], self.vib[:]
+    return r
+
+  def dump(self):
+    return {"cap":self.cap, "start":self.start, "ts":b64(self.ts), "code":b64(self.code),
+            "pir":b64(self.pir), "vib":b64(self.vib)}
+
+  @classmethod
+  def load(cls, cap, d):
+    old = cls(d["cap"])
+    for name in ("ts", "code", "pir", "vib"):
+      getattr(old, name).frombytes(base64.b64decode(d[name]))
+    old.start = d["start"]
+    if old.cap == cap:
+      return old
+    # HISTORY_CAP changed since the snapshot: re-append, keeping the newest.
+    ring = cls(cap)
+    for row in old.range(0, U32):
+      ring.append(*row)
+    return ring
+
+  def _bisect(self, t):
+    # First logical index whose timestamp is >= t.
+    lo, hi = 0, len(self.ts)
+    while lo < hi:
+      mid = (lo + hi) // 2
+      if self.ts[(self.start + mid) % self.cap] < t:
+        lo = mid + 1
+      else:
+        hi = mid
+    return lo
+
+  def range(self, since, until):
+    lo, hi = self._bisect(since), self._bisect(until + 1)
+    out = []
+    for k in range(lo, hi):
+      i = (self.start + k) % self.cap
+      out.append((self.ts[i], self.code[i], self.pir[i], self.vib[i]))
+    return out
+
+
+class Roll:
+  # One node's rollup buckets at one resolution, oldest first: parallel
+  # typed arrays (bucket, count, first, last, motion, vibration, other),
+  # 28 bytes per bucket. Buckets are found by binary search.
+  def __init__(self):
+    self.cols = tuple(array("I") for _ in range(7))
+
+  def add(self, b, code, now):
+    bs = self.cols[0]
+    i = len(bs) - 1
+    if i < 0 or bs[i] != b:
+      i = bisect_left(bs, b)
+      if i == len(bs) or bs[i] != b:
+        for col, v in zip(self.cols, (b, 0, now, now, 0, 0, 0)):
+          col.insert(i, v)
+    c = self.cols
+    c[1][i] += 1
+    c[2][i] = min(c[2][i], now)
+    c[3][i] = max(c[3][i], now)
+    c[4 + (code - 1 if code else 2)][i] += 1
+
+  def evict(self, cutoff):
+    n = bisect_left(self.cols[0], cutoff)
+    if n:
+      for col in self.cols:
+        del col[:n]
+    return len(self.cols[0])
+
+  def range(self, since, until):
+    bs = self.cols[0]
+    return [tuple(col[i] for col in self.cols)
+            for i in range(bisect_left(bs, since), bisect_right(bs, until))]
+
+  def copy(self):
+    r = Roll()
+    r.cols = tuple(col[:] for col in self.cols)
+    return r
+
+  def dump(self):
+    return [b64(col) for col in self.cols]
+
+  @classmethod
+  def load(cls, d):
+    r = cls()
+    for col, data in zip(r.cols, d):
+      col.frombytes(base64.b64decode(data))
+    return r
+
+
+class MemoryStore:
+  def __init__(self, path=None):
+    self.nodes = {}
+    self.lock = threading.Lock()
+    self.changed = threading.Condition(self.lock)
+    self.ver = 0
+    self.rings = {}
+    self.rolls = {res: {} for res in ROLLUPS}   # res -> node -> Roll
+    self.latest = self.evicted = 0              # newest event time, last sweep
+    self.path = path
+    if path:
+      # Log segments events-<n>.log hold one JSON event per line; snapshot.json
+      # holds the full state as of the start of segment "segment".
+      os.makedirs(path, exist_ok=True)
+      self.io = threading.Lock()       # serialises log file writes
+      self.snapping = threading.Lock() # one snapshot at a time
+      self.pending, self.unsnapped, self.writer, self.torn = [], 0, None, False
+      self.seg = self._recover()
+      self.logf = open(self._seg_path(self.seg), "a", encoding="utf-8")
+      atexit.register(self.flush)
+
+  def names(self):
+    return sorted(self.nodes.keys())
+
+  def get(self, node):
+    n = self.nodes.get(node)
+    if n is None:
+      return None
+    return {"last_update":n["last_update"], "data":dict(n["data"])}
+
+  def node_counts(self, before):
+    with self.lock:
+      return len(self.nodes), sum(1 for n in self.nodes.values() if n["last_update"] < before)
+
+  def apply(self, node, state, t, pirH, vibH, now):
+    self.apply_many([(node, state, t, pirH, vibH, now)])
+
+  def apply_many(self, events):
+    with self.lock:
+      done = 0
+      try:
+        for e in events:
+          self._apply(*e)
+          done += 1
+      except Exception as err:
+        raise ApplyError(done, done, err) from err
+      finally:
+        # Log exactly the prefix that reached memory, so disk never diverges.
+        if self.path and done:
+          self.pending.extend(json.dumps(e, separators=(",",":")) for e in events[:done])
+          self.unsnapped += done
+          self._start_writer()
+        if done:
+          self.changed.notify_all()
+
+  def _apply(self, node, state, t, pirH, vibH, now):
+    pirSet, vibSet, pirInc, vibInc = hit_update(state, pirH, vibH)
+    n = self.nodes.get(node)
+    if n is None:
+      n = self.nodes[node] = empty_node()
+    d = n["data"]
+    d["pirHits"] = pirSet if pirSet is not None else d["pirHits"] + pirInc
+    d["vibHits"] = vibSet if vibSet is not None else d["vibHits"] + vibInc
+    d["state"] = state
+    d["time"]  = t
+    n["last_update"] = now
+    ring = self.rings.get(node)
+    if ring is None:
+      ring = self.rings[node] = Ring(HISTORY_CAP)
+    code = state_code(state)
+    ring.append(now, code, d["pirHits"], d["vibHits"])
+    self._rollup(node, code, now)
+    self.ver += 1
+
+  def _rollup(self, node, code, now):
+    for res, (width, keep) in ROLLUPS.items():
+      roll = self.rolls[res].get(node)
+      if roll is None:
+        roll = self.rolls[res][node] = Roll()
+      roll.add(now - now % width, code, now)
+    self.latest = max(self.latest, now)
+    # Retention sweep over every node, like SQLiteStore._evict, so nodes
+    # that stopped reporting lose their expired buckets too.
+    if abs(self.latest - self.evicted) >= EVICT_EVERY:
+      self.evicted = self.latest
+      for res, (width, keep) in ROLLUPS.items():
+        per = self.rolls[res]
+        for n in [n for n, roll in per.items() if not roll.evict(self.latest - keep)]:
+          del per[n]
+
+  # --- durability (only when constructed with a path) ---
+
+  def _seg_path(self, n):
+    return os.path.join(self.path, "events-%08d.log" % n)
+
+  def _segments(self):
+    return sorted(int(m.group(1)) for m in
+                  (re.fullmatch(r"events-(\d+)\.log", f) for f in os.listdir(self.path)) if m)
+
+  def _start_writer(self):
+    # Lazily, and again after a fork, since threads do not survive fork().
+    if self.writer is None or self.writer[1] != os.getpid():
+      t = threading.Thread(target=self._write_loop, name="store-writer", daemon=True)
+      self.writer = (t, os.getpid())
+      t.start()
+
+  def _write_loop(self):
+    while True:
+      time.sleep(FLUSH_EVERY)
+      try:
+        self.flush()
+        if self.unsnapped >= SNAPSHOT_EVERY:
+          self.snapshot()
+      except Exception:
+        # Disk full, EIO, ...: nothing is lost (unwritten lines went back
+        # to pending), so keep the writer alive and retry after a pause.
+        log.exception("store writer for %s failed; retrying", self.path)
+        time.sleep(1)
+
+  def flush(self):
+    # Group commit: everything applied since the last flush goes out in one
+    # write + fsync, off the request path.
+    with self.io:
+      with self.lock:
+        lines, self.pending = self.pending, []
+      if lines:
+        self._write(self.logf, lines)
+
+  def _write(self, f, lines):
+    # On failure the lines go back to the front of pending for the next
+    # attempt. A partial write may have left a torn line, so the next write
+    # starts on a fresh line (replay skips the torn and the empty one).
+    try:
+      f.write(("\n" if self.torn else "") + "\n".join(lines) + "\n")
+      f.flush()
+      os.fsync(f.fileno())
+    except BaseException:
+      with self.lock:
+        self.pending[:0] = lines
+        self.torn = True
+      raise
+    self.torn = False
+
+  def snapshot(self):
+    with self.snapping:
+      with self.io:
+        new = open(self._seg_path(self.seg + 1), "a", encoding="utf-8")
+        with self.lock:
+          # Cut over to a new segment and copy the state in the same critical
+          # section, so the snapshot covers exactly the segments before it.
+          # Only cheap copies happen here (dicts, memcpy of typed arrays);
+          # encoding and writing happen after ingest is running again.
+          lines, self.pending = self.pending, []
+          old, self.logf, self.seg = self.logf, new, self.seg + 1
+          unsnapped, self.unsnapped = self.unsnapped, 0
+          seg, ver, latest = self.seg, self.ver, self.latest
+          nodes = {k: (v["last_update"], dict(v["data"])) for k, v in self.nodes.items()}
+          rings = {k: r.copy() for k, r in self.rings.items()}
+          rolls = {res: {n: r.copy() for n, r in per.items()} for res, per in self.rolls.items()}
+        try:
+          if lines:
+            self._write(old, lines)
+        except BaseException:
+          # Those lines now go to the new segment, which the snapshot must
+          # not claim to cover; give up on this snapshot.
+          with self.lock:
+            self.unsnapped += unsnapped
+          raise
+        finally:
+          old.close()
+      try:
+        state = {"segment":seg, "ver":ver, "latest":latest,
+                 "nodes":{k: {"last_update":lu, "data":d} for k, (lu, d) in nodes.items()},
+                 "rings":{k: r.dump() for k, r in rings.items()},
+                 "rolls":{res: {n: r.dump() for n, r in per.items()} for res, per in rolls.items()}}
+        tmp = os.path.join(self.path, "snapshot.json.tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+          json.dump(state, f, separators=(",",":"))
+          f.flush()
+          os.fsync(f.fileno())
+        os.replace(tmp, os.path.join(self.path, "snapshot.json"))
+      except BaseException:
+        # The previous snapshot and every segment since are still on disk.
+        with self.lock:
+          self.unsnapped += unsnapped
+        raise
+      for n in self._segments():
+        if n < seg:
+          os.remove(self._seg_path(n))
+
+  def _recover(self):
+    # Load the latest snapshot, then replay only the log segments after it.
+    # A torn last line from a crash mid-write is skipped.
+    seg = 0
+    snap = os.path.join(self.path, "snapshot.json")
+    if os.path.exists(snap):
+      with open(snap, encoding="utf-8") as f:
+        state = json.load(f)
+      seg, self.ver = state["segment"], state["ver"]
+      self.nodes = state["nodes"]
+      self.rings = {k: Ring.load(HISTORY_CAP, d) for k, d in state["rings"].items()}
+      self.latest = self.evicted = state["latest"]
+      self.rolls = {res: {n: Roll.load(d) for n, d in state["rolls"].get(res, {}).items()}
+                    for res in ROLLUPS}
+    segs = self._segments()
+    for n in segs:
+      if n < seg:
+        os.remove(self._seg_path(n))
+        continue
+      with open(self._seg_path(n), encoding="utf-8") as f:
+        for line in f:
+          try:
+            e = json.loads(line)
+          except ValueError:
+            continue
+          self._apply(*e)
+          self.unsnapped += 1   # a long tail gets compacted soon after boot
+    return max(segs + [seg]) + 1
+
+  def history(self, node, since, until):
+    with self.lock:
+      ring = self.rings.get(node)
+      return ring.range(since, until) if ring else []
+
+  def rollups(self, res, node, since, until):
+    # Buckets older than the retention window are hidden even before the
+    # next sweep removes them, so both backends give the same answer.
+    with self.lock:
+      since = max(since, self.latest - ROLLUPS[res][1])
+      per = self.rolls[res]
+      out = {}
+      for n in ([node] if node else sorted(per)):
+        rows = per[n].range(since, until) if n in per else []
+        if rows:
+          out[n] = rows
+      return out
+
+  def version(self):
+    return self.ver
+
+  def wait(self, since, timeout):
+    with self.changed:
+      self.changed.wait_for(lambda: self.ver != since, timeout)
+      return self.ver
+
+
+class SQLiteStore:
+  SCHEMA = """
+  CREATE TABLE IF NOT EXISTS nodes(
+    node TEXT PRIMARY KEY,
+    last_update INTEGER NOT NULL,
+    state TEXT NOT NULL,
+    time TEXT NOT NULL,
+    pirHits INTEGER NOT NULL,
+    vibHits INTEGER NOT NULL
+  );
+  CREATE TABLE IF NOT EXISTS meta(id INTEGER PRIMARY KEY CHECK (id=0), version INTEGER NOT NULL);
+  INSERT OR IGNORE INTO meta VALUES(0, 0);
+  CREATE TRIGGER IF NOT EXISTS nodes_ins AFTER INSERT ON nodes
+    BEGIN UPDATE meta SET version=version+1 WHERE id=0; END;
+  CREATE TRIGGER IF NOT EXISTS nodes_upd AFTER UPDATE ON nodes
+    BEGIN UPDATE meta SET version=version+1 WHERE id=0; END;
+  -- Per-node ring: seq % cap picks the slot, so each node keeps at most cap rows.
+  CREATE TABLE IF NOT EXISTS history(
+    node TEXT NOT NULL,
+    slot INTEGER NOT NULL,
+    seq INTEGER NOT NULL,
+    ts INTEGER NOT NULL,
+    code INTEGER NOT NULL,
+    pirHits INTEGER NOT NULL,
+    vibHits INTEGER NOT NULL,
+    PRIMARY KEY(node, slot)
+  ) WITHOUT ROWID;
+  CREATE INDEX IF NOT EXISTS history_ts ON history(node, ts);
+  CREATE INDEX IF NOT EXISTS history_seq ON history(node, seq);
+  CREATE TABLE IF NOT EXISTS rollups(
+    res TEXT NOT NULL,
+    node TEXT NOT NULL,
+    bucket INTEGER NOT NULL,
+    count INTEGER NOT NULL,
+    first INTEGER NOT NULL,
+    last INTEGER NOT NULL,
+    motion INTEGER NOT NULL,
+    vibration INTEGER NOT NULL,
+    other INTEGER NOT NULL,
+    PRIMARY KEY(res, node, bucket)
+  ) WITHOUT ROWID;
+  CREATE INDEX IF NOT EXISTS rollups_bucket ON rollups(res, bucket);
+  """
+
+  POLL = 0.25  # seconds between version checks while waiting
+
+  # One statement per event, so concurrent workers never lose an increment.
+  UPSERT = """
+  INSERT INTO nodes(node,last_update,state,time,pirHits,vibHits)
+  VALUES(:node,:now,:state,:t,COALESCE(:pirSet,:pirInc),COALESCE(:vibSet,:vibInc))
+  ON CONFLICT(node) DO UPDATE SET
+    last_update=excluded.last_update, state=excluded.state, time=excluded.time,
+    pirHits=COALESCE(:pirSet, pirHits + :pirInc),
+    vibHits=COALESCE(:vibSet, vibHits + :vibInc)
+  """
+
+  # Same clamping as Ring.append: history timestamps never go backwards.
+  HISTORY = """
+  INSERT OR REPLACE INTO history(node,slot,seq,ts,code,pirHits,vibHits)
+  SELECT :node, s % :cap, s, MAX(:now, COALESCE(last.ts, 0)), :code, n.pirHits, n.vibHits
+  FROM nodes n, (SELECT COALESCE(MAX(seq),-1)+1 AS s FROM history WHERE node=:node)
+  LEFT JOIN (SELECT ts FROM history WHERE node=:node ORDER BY seq DESC LIMIT 1) last
+  WHERE n.node=:node
+  """
+
+  ROLLUP = """
+  INSERT INTO rollups(res,node,bucket,count,first,last,motion,vibration,other)
+  VALUES(:res,:node,:bucket,1,:now,:now,:code=1,:code=2,:code=0)
+  ON CONFLICT(res,node,bucket) DO UPDATE SET
+    count=count+1, first=MIN(first,:now), last=MAX(last,:now),
+    motion=motion+(:code=1), vibration=vibration+(:code=2), other=other+(:code=0)
+  """
+
+  def __init__(self, path):
+    self.path = path
+    self.evicted = 0
+    self.local = threading.local()
+    with self.conn() as c:
+      c.executescript(self.SCHEMA)
+
+  def conn(self):
+    # Connections are opened lazily per thread and per process, so a store
+    # created before gunicorn forks its workers is still safe to use.
+    c = getattr(self.local, "conn", None)
+    if c is None or self.local.pid != os.getpid():
+      c = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+      c.execute("PRAGMA journal_mode=WAL")
+      c.execute("PRAGMA synchronous=NORMAL")
+      self.local.conn, self.local.pid = c, os.getpid()
+    return c
+
+  def names(self):
+    return [r[0] for r in self.conn().execute("SELECT node FROM nodes ORDER BY node")]
+
+  def get(self, node):
+    r = self.conn().execute(
+      "SELECT last_update,state,time,pirHits,vibHits FROM nodes WHERE node=?", (node,)).fetchone()
+    if r is None:
+      return None
+    return {"last_update":r[0], "data":{"state":r[1],"time":r[2],"pirHits":r[3],"vibHits":r[4]}}
+
+  def node_counts(self, before):
+    return tuple(self.conn().execute(
+      "SELECT COUNT(*), COALESCE(SUM(last_update < ?),0) FROM nodes", (before,)).fetchone())
+
+  def apply(self, node, state, t, pirH, vibH, now):
+    self.apply_many([(node, state, t, pirH, vibH, now)])
+
+  def apply_many(self, events):
+    # One write transaction for the whole batch instead of one per event.
+    c = self.conn()
+    c.execute("BEGIN IMMEDIATE")
+    try:
+      for i, e in enumerate(events):
+        p = self._params(*e)
+        c.execute(self.UPSERT, p)
+        c.execute(self.HISTORY, p)
+        for res, (width, keep) in ROLLUPS.items():
+          c.execute(self.ROLLUP, dict(p, res=res, bucket=p["now"] - p["now"] % width))
+      if events:
+        self._evict(c, events[-1][-1])
+    except Exception as err:
+      c.execute("ROLLBACK")
+      raise ApplyError(0, i, err) from err
+    except BaseException:
+      c.execute("ROLLBACK")
+      raise
+    c.execute("COMMIT")
+
+  def _params(self, node, state, t, pirH, vibH, now):
+    pirSet, vibSet, pirInc, vibInc = hit_update(state, pirH, vibH)
+    return {"node":node, "now":now, "state":state, "t":t,
+            "pirSet":pirSet, "vibSet":vibSet, "pirInc":pirInc, "vibInc":vibInc,
+            "code":state_code(state), "cap":HISTORY_CAP}
+
+  def _evict(self, c, now):
+    # Retention sweep, at most once per EVICT_EVERY in each process.
+    if abs(now - self.evicted) < EVICT_EVERY:
+      return
+    self.evicted = now
+    for res, (width, keep) in ROLLUPS.items():
+      c.execute("DELETE FROM rollups WHERE res=? AND bucket < ?", (res, now - keep))
+
+  def rollups(self, res, node, since, until):
+    # Same retention cut-off as MemoryStore, relative to the newest event.
+    latest = self.conn().execute("SELECT COALESCE(MAX(last_update),0) FROM nodes").fetchone()[0]
+    since = max(since, latest - ROLLUPS[res][1])
+    q = "SELECT node,bucket,count,first,last,motion,vibration,other FROM rollups WHERE res=? AND bucket BETWEEN ? AND ?"
+    args = [res, since, until]
+    if node:
+      q += " AND node=?"
+      args.append(node)
+    out = {}
+    for r in self.conn().execute(q + " ORDER BY node, bucket", args):
+      out.setdefault(r[0], []).append(tuple(r[1:]))
+    return out
+
+  def history(self, node, since, until):
+    return self.conn().execute(
+      "SELECT ts,code,pirHits,vibHits FROM history WHERE node=? AND ts BETWEEN ? AND ? ORDER BY seq",
+      (node, since, until)).fetchall()
+
+  def version(self):
+    return self.conn().execute("SELECT version FROM meta WHERE id=0").fetchone()[0]
+
+  def wait(self, since, timeout):
+    # Other workers write the database, so there is nothing to block on;
+    # poll the version row (a single indexed read) until it moves.
+    end = time.monotonic() + timeout
+    v = self.version()
+    while v == since and time.monotonic() < end:
+      time.sleep(self.POLL)
+      v = self.version()
+    return v
+
+
+def make_store(spec=None):
+  # NODE_STORE="memory" (default), "memory:/state/dir" (memory plus event
+  # log and snapshots in that directory) or "sqlite:/path/to/nodes.db"
+  spec = spec or os.environ.get("NODE_STORE", "memory")
+  if spec == "memory":
+    return MemoryStore()
+  if spec.startswith("memory:"):
+    return MemoryStore(spec[len("memory:"):] or "state")
+  if spec.startswith("sqlite:"):
+    return SQLiteStore(spec[len("sqlite:"):] or "nodes.db")
+  raise ValueError("unknown NODE_STORE: %r" % spec)